@@ -40,6 +40,11 @@
 ### to read relays status from a devices ...
 ###     sudo python ./usblrb.py -d 0
 
+### to keep running and set relays from stdin lines "<deviceno> <status>" ...
+###     sudo python ./usblrb.py --daemon
+### (devices are found and opened only once, so this is much faster
+###  for scripts that switch relays often; stop with EOF or SIGTERM)
+
 ### DEVICE: zero-based CH341A device list index 
 ### STATUS: Bit 0..7 represent REL1..REL8 status:
 ### bit0..7 set = relay1..8 on
@@ -55,18 +60,38 @@
 ### It may be tricky, but somehow you will succeed!
 ### Google for it!
 
-import usb.core
-import usb.util
+### If the "libusb1" python package is installed, it is used instead of
+### pyUSB. It is a thinner wrapper around libusb-1.0, so every transfer
+### has less python overhead. Install it with: pip install libusb1
+### see https://github.com/vpelletier/python-libusb1
+
+try:
+    import usb1
+    USBError = usb1.USBError
+except ImportError: # no libusb1, use pyUSB
+    usb1 = None
+    import usb.core
+    import usb.util
+    USBError = usb.core.USBError
 
 ### These libs likely are already pre-installed on RaspPi...
 import sys
-import time
-import getopt
+import array
+### (getopt and signal are only imported where the command line
+###  part needs them, so "import usblrb" from other scripts stays quick)
 
 ############# (Some of) the CH341A API ####################
 
 ### global "USB device" object
 dev = None # we will get and use it later
+### global libusb1 context (only used with libusb1)
+context = None
+### devices we took away from their kernel driver (only used with pyUSB)
+detachedDevs = set()
+
+### CH341A vendor and product ID (in EPP/MEM/I2C mode)
+vendorId = 0x1A86
+productId = 0x5512
 
 ### from CH341A USB Descriptor... on Linux type: "lsusb -v"
 interface = 0 # CH341A only has one interface 0
@@ -80,11 +105,16 @@ ep2in  = 0x82 # CH341A Endpoint for incoming data (CH341A->PC)
 ch341a_set_output = 0xA1
 ch341a_get_input = 0xA0
 
-### CH341A API function
-def setOutput(DataByte): 
+# Note: 0xA1/0xA0 are command bytes of the CH341A bulk command stream
+# (ep2out), not vendor control requests. The WIN driver sends them on the
+# bulk pipe and so does the kernel driver in abacomrelay_driver. How
+# many frames go into one bulk write is set by FRAMES_PER_WRITE.
+
+### Encode one CH341A "set output" frame (11 bytes)
+def encodeOutput(DataByte):
+    # type: (int) -> bytes
     ### Message bytes were captured from WIN driver DLL.
     ### NOT ask me what these bytes mean in detail!
-    global dev
     msg = bytearray()
     msg.append(ch341a_set_output)
     msg.append(0x6a)
@@ -97,16 +127,175 @@ def setOutput(DataByte):
     msg.append(0x00)
     msg.append(0x00)
     msg.append(0x00)
-    dev.write(ep2out,msg,0)
+    return bytes(msg)
+
+### Only the data byte changes between frames, so all 256 possible
+### "set output" frames and the "get input" frame are built once here
+### and reused for every transfer.
+OUT_FRAMES = tuple(encodeOutput(b) for b in range(256))
+IN_FRAME = bytes((ch341a_get_input,))
+
+### Input reports are read into this one buffer instead of a new one per
+### read (pyUSB only). NOTE: getInput() and setOutputsGetInput() return
+### it, so the content is only valid until the next read.
+RX_BUF = array.array('B', bytes(6))
+
+### Frames per bulk write. The WIN driver and the kernel driver in
+### abacomrelay_driver both send exactly one frame per transfer, which
+### is the only format known to work, so that is the default.
+### FRAMES_PER_WRITE = 2 packs two frames (22 bytes) into one 32 byte
+### packet, so no frame is split over two packets, and halves the
+### number of transfers. It also appends the A0 input request to the
+### last output frames instead of sending it alone. This is NOT verified
+### on a CH341A yet, only use it after testing it with your board!
+PACKET_SIZE = 32
+FRAMES_PER_WRITE = 1
+
+### Group the frames for the given output states into bulk writes.
+### tail (e.g. IN_FRAME) gets a write of its own, with FRAMES_PER_WRITE
+### above 1 it is appended to the last write if it still fits.
+def packFrames(DataBytes, tail=b""):
+    frames = [OUT_FRAMES[b] for b in DataBytes]
+    writes = [b"".join(frames[i:i+FRAMES_PER_WRITE])
+              for i in range(0, len(frames), FRAMES_PER_WRITE)]
+    if tail:
+        if (FRAMES_PER_WRITE > 1 and writes
+                and len(writes[-1]) + len(tail) <= PACKET_SIZE):
+            writes[-1] += tail
+        else:
+            writes.append(tail)
+    return tuple(writes)
+
+### Read timeout in ms (pyUSB's default). A CH341A that is not a relay
+### board may never answer, so reads must not wait forever.
+readTimeout = 1000
+
+### Low level bulk transfers on the (global) device, for libusb1 or pyUSB
+if usb1 is not None:
+    def usbWrite(data):
+        dev.bulkWrite(ep2out,data,0)
+
+    def usbRead():
+        return dev.bulkRead(ep2in,6,readTimeout)
+else:
+    def usbWrite(data):
+        dev.write(ep2out,data,0)
+
+    def usbRead():
+        # RX_BUF keeps the last read's bytes, so an empty read must fail
+        if not dev.read(ep2in,RX_BUF,readTimeout):
+            raise USBError('No data read from CH341A')
+        return RX_BUF
+
+def usbWriteAll(writes):
+    for data in writes:
+        usbWrite(data)
+
+### CH341A API function
+def setOutput(DataByte): 
+    usbWrite(OUT_FRAMES[DataByte])
+
+### CH341A API function
+### Same as setOutput() for a whole sequence of states. The frames are
+### sent FRAMES_PER_WRITE per bulk transfer (see packFrames()).
+def setOutputs(DataBytes):
+    usbWriteAll(packFrames(DataBytes))
 
 ### CH341A API function
 def getInput():
+    usbWrite(IN_FRAME)
+    return usbRead()
+
+### CH341A API function
+### Like getInput(), but the given output states are sent first. With
+### FRAMES_PER_WRITE above 1 the input request shares the bulk transfer
+### of the last of them, saving a round-trip per read.
+def setOutputsGetInput(DataBytes):
+    usbWriteAll(packFrames(DataBytes, IN_FRAME))
+    return usbRead()
+
+### List all CH341A devices on the bus
+### With libusb1 this opens the global context, see closeContext().
+def findDevices():
+    global context
+    if usb1 is not None:
+        if context is None:
+            context = usb1.USBContext()
+            context.open()
+        return [d for d in context.getDeviceList(skip_on_error=True)
+                if d.getVendorID() == vendorId and d.getProductID() == productId]
+    return list(usb.core.find(find_all=1, idVendor=vendorId, idProduct=productId))
+
+### Close the global libusb1 context (after closeDevice()). libusb1
+### warns about contexts left open, they can hang the interpreter on exit.
+def closeContext():
+    global context
+    if context is not None:
+        context.close()
+        context = None
+
+### Get (bus, address) of a device from findDevices()
+def deviceLocation(aDev):
+    if usb1 is not None:
+        return aDev.getBusNumber(), aDev.getDeviceAddress()
+    return aDev.bus, aDev.address
+
+### CH341A API function
+### Get the (global) device ready once, before the first transfer:
+### detach a kernel driver bound to it (e.g. abacomrelay), set the
+### configuration if none is active yet (setting it again would reset
+### the device) and claim the interface. closeDevice() undoes this,
+### on an error openDevice() undoes it itself.
+### With libusb1 the global device is replaced by its opened handle.
+### Note: the CH341A has no latency timer like FTDI chips, every
+### bulk write is sent right away.
+def openDevice():
     global dev
-    msg = bytearray()
-    msg.append(ch341a_get_input)
-    dev.write(ep2out,msg,0)
-    response=dev.read(ep2in,6)
-    return response 
+    if usb1 is not None:
+        handle = dev.open()
+        try:
+            try:
+                handle.setAutoDetachKernelDriver(True)
+            except usb1.USBErrorNotSupported: # not available on every platform
+                pass
+            if handle.getConfiguration() == 0:
+                handle.setConfiguration(1)
+            handle.claimInterface(interface)
+        except BaseException: # don't leak the handle
+            handle.close()
+            raise
+        dev = handle
+        return
+    try:
+        if dev.is_kernel_driver_active(interface):
+            dev.detach_kernel_driver(interface)
+            detachedDevs.add(dev)
+    except NotImplementedError: # not available on every platform
+        pass
+    try:
+        try:
+            dev.get_active_configuration()
+        except usb.core.USBError: # not configured yet
+            dev.set_configuration()
+        usb.util.claim_interface(dev, interface)
+    except BaseException: # give the device back to its kernel driver
+        if dev in detachedDevs:
+            detachedDevs.discard(dev)
+            dev.attach_kernel_driver(interface)
+        raise
+
+### CH341A API function
+### Release the (global) device and give it back to its kernel driver
+def closeDevice():
+    global dev
+    if usb1 is not None:
+        dev.releaseInterface(interface) # auto detach re-attaches the driver
+        dev.close()
+        return
+    usb.util.release_interface(dev, interface)
+    if dev in detachedDevs:
+        detachedDevs.discard(dev)
+        dev.attach_kernel_driver(interface)
 
 ############## USB LRB relay specific functions ##########
 
@@ -117,29 +306,63 @@ DATA =   0x20 # to A6275 Serial in
 PFT  =   0x40 # port function test from A6275 PIN5 (REL1)
 READ =   0x80 # from A6275 Serial out
 
+### Bit masks in shift order (A6275 gets/gives bit 7 first)
+BITS = (0x80, 0x40, 0x20, 0x10, 0x08, 0x04, 0x02, 0x01)
+
+### Output states to shift a status byte into the A6275...
+### The A6275 takes DATA on the rising CLK edge only (data sheet:
+### setup/hold times around CLK low->high), so every bit needs just two
+### states: DATA with CLK low, then DATA with CLK high. The falling CLK
+### edge comes for free with the first state of the next bit, and the
+### final "all lines 0" state ends the last pulse.
+def computeSequence(aStatus):
+    # type: (int) -> list
+    seq = []
+    for mask in BITS: # Bit 7..0 testen...
+        # -1 (all ones) for a "1" bit, 0 for a "0" bit -> DATA or 0
+        data = DATA & -bool(aStatus & mask)
+        seq.append(data) #DATA high "1" or low "0", CLK low
+        seq.append(CLK | data) #CLK high
+    seq.append(0) #All lines 0
+    return seq
+
+### The status is a single byte, so the writes for the whole shift
+### sequence (17 frames, 9 writes) are built once for each of the 256
+### possible values.
+SHIFT_WRITES = tuple(packFrames(computeSequence(v)) for v in range(256))
+
 ### Shift bits from CH341A to Allegro A6275 driver chip...
+### All callers leave CLK low before calling this.
+### Only the lower 8 bits of aStatus are used.
 def shiftOutBits(aStatus):
-    setOutput(0) #All lines low
-    for i in range(0,8): # Bit 0..7 testen...
-        if (aStatus & (1 << (7-i)))!=0 :
-            setOutput(DATA) #DATA high "1"
-	    # and generate CLK pulse...
-            setOutput(CLK or DATA) #CLK high
-            setOutput(DATA) #CLK low
-        else:
-            setOutput(0) #DATA low "0"
-	    # and generate CLK pulse...
-            setOutput(CLK) #CLK high
-            setOutput(0) #CLK low
-    setOutput(0) #All lines 0
+    usbWriteAll(SHIFT_WRITES[aStatus & 0xFF])
+
+### Same for the complete setRelays() sequence (20 frames, 10 writes):
+SETRELAYS_WRITES = tuple(packFrames(
+    [0] # Latch low
+    + computeSequence(v) # this is silent so far (without latch)
+    # now generate a latch clock to output data to relays...
+    + [LATCH] #Latch high
+    + [0]) # Latch, CLK, OE low
+    for v in range(256))
 
 ### Shift out (write / set) the relays status to Allegro A6275
+### The latch frame is in the last write, so on a USB error part way
+### through, the shifted data is not latched onto the relays.
+### Only the lower 8 bits of aStatus are used.
 def setRelays(aStatus):
-    setOutput(0) # Latch low
-    shiftOutBits(aStatus) # this is silent so far (without latch)
-    # now generate a latch clock to output data to relays...
-    setOutput(LATCH) #Latch high
-    setOutput(0) # Latch, CLK, OE low
+    usbWriteAll(SETRELAYS_WRITES[aStatus & 0xFF])
+
+### Build the status byte from the CH341A input states read while
+### shifting out the A6275 (bit 7 first)...
+def decodeResponse(inputStates):
+    # type: (list) -> int
+    result = 0
+    for mask, inputState in zip(BITS, inputStates):
+        # READ bits from A6275 Serial out (at D7 line)...
+        if inputState & READ:
+           result = result | mask
+    return result
 
 ### Shift in (read/verify) the relays status from Allegro A6275
 def getRelays():
@@ -150,26 +373,28 @@ def getRelays():
     ### have different state, than its (latched) output register.
 
     global dev
-    result = 0
+    inputStates = []
     
-    setOutput(0) # all lines low
-    for i in range(0,8): # shift out bit 0..7 from A6275...
-        msg = getInput() # CH341A API call
-        inputState = msg[0] # Get status of CH341A D0..D7 lines
-        # READ bits from A6275 Serial out (at D7 line)...
-        if (inputState & READ)!=0: 
-           result = result | (1 << (7-i));
-        # ...and generate CLK pulse for next bi from A6275t...
-        setOutput(CLK) #CLK high
-        setOutput(0) #CLK low
+    pending = [0] # all lines low
+    for _ in BITS: # shift out bit 7..0 from A6275...
+        # pending output states go out with the input request
+        msg = setOutputsGetInput(pending) # CH341A API call
+        inputStates.append(msg[0]) # Get status of CH341A D0..D7 lines
+        # ...and generate CLK pulse for next bit from A6275
+        # (sent together with the next input request)...
+        pending = [CLK, 0] #CLK high, CLK low
+    setOutputs(pending) # last CLK pulse
+
+    result = decodeResponse(inputStates)
+    inputState = inputStates[-1] # state read with the last bit
 
     powerFail = 0
     if result == 255:
-        powerFail == ((inputState & PFT)!=0)
+        powerFail = 1 if (inputState & PFT) else 0
         if powerFail!=0:
             result = -1
 
-    if powerFail == 0 :
+    if result != -1: # no write back after a power fail
         shiftOutBits(result) # write back status we shifted out before
 
     return result
@@ -177,33 +402,87 @@ def getRelays():
 ################################################################
 # Setting the relays could be simply like this for one card...
 #
-#    dev = usb.core.find(idVendor=0x1A86, idProduct=0x5512) 
+#    dev = findDevices()[0]
+#    openDevice()
 #    setRelays(SomeStatus)
+#    closeDevice()
+#    closeContext()
 #
 # But we like to have it nicer,
 # so everthing below is getting arguments and error checking...
 ################################################################
 
+### daemon mode: set relays from stdin lines "<deviceno> <status>"
+### Each device is opened once and kept open until EOF or SIGTERM.
+def runDaemon(devs):
+    import signal
+    global dev
+    opened = {} # device index -> opened device
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    try:
+        for line in sys.stdin:
+            try:
+                devnoString, statusString = line.split()
+                devIndex = int(devnoString)
+                newStat = int(statusString)
+            except ValueError:
+                print('Invalid command! (use: <deviceno> <status>)', flush=True)
+                continue
+            if not 0 <= newStat <= 255:
+                print('Status value out of range (must be 0..255)', flush=True)
+                continue
+            if devIndex not in opened and not 0 <= devIndex < len(devs):
+                print('Device not found!', flush=True)
+                continue
+            try: # a USB error only fails this command, not the daemon
+                if devIndex not in opened:
+                    dev = devs[devIndex]
+                    openDevice()
+                    opened[devIndex] = dev
+                dev = opened[devIndex]
+                setRelays(newStat)
+            except USBError as e:
+                print('USB error!', e, flush=True)
+                continue
+            print('Status set to', newStat, flush=True)
+    finally:
+        for openedDev in opened.values():
+            dev = openedDev # closeDevice() works on the global device
+            try:
+                closeDevice()
+            except USBError: # e.g. unplugged meanwhile
+                pass
+
+usage = ('usage: sudo usblrb.py -d <deviceno> -s <status>\n'
+         '   or: sudo usblrb.py --daemon')
+
 ### main method processes the command line ...
 def main(argv):
+    import getopt
     global dev
 
     ### Get string args from command line...
     devnoString= ''
     statusString = ''
+    daemon = False
     try:
-        opts, args = getopt.getopt(argv,"hd:s:",["deviceno=","status="])
+        opts, args = getopt.getopt(argv,"hd:s:",["deviceno=","status=","daemon"])
     except getopt.GetoptError:
-        print('usage: sudo usblrb.py -d <deviceno> -s <status>')
+        print(usage)
         sys.exit(2)
     for opt, arg in opts:
         if opt == '-h':
-            print('usage: sudo usblrb.py -d <deviceno> -s <status>')
+            print(usage)
             sys.exit()
         elif opt in ("-d", "--deviceno"):
             devnoString = arg
         elif opt in ("-s", "--status"):
             statusString = arg
+        elif opt == "--daemon":
+            daemon = True
+    if daemon and (devnoString!='' or statusString!=''):
+        print(usage) # --daemon takes device and status from stdin
+        sys.exit(2)
     ### We got the args now, so we can try to use it....
 
 
@@ -214,17 +493,19 @@ def main(argv):
     ### Method 2: Specify bus and address ... (not used here)
     # dev = usb.core.find(bus=1, address=35) - not used here
     ### Method 3: Find all CH341A and pick one from the list ... that is my favourite!
-    devs_iter = usb.core.find(find_all=1, idVendor=0x1A86, idProduct=0x5512) # List of all CH341A in EPP/MEM/I2C mode
-    if devs_iter is None:
+    devs = findDevices() # List of all CH341A in EPP/MEM/I2C mode
+    if not devs:
        print('No device found!')
        sys.exit()
 
-    devs = list(devs_iter)
+    if daemon:
+        runDaemon(devs)
+        sys.exit()
     if devnoString=='': # no device specified in command line
-        for i in range(0, len(devs)): # Print out the decive list...
-            dev = devs[i]
-            print('DEVICE',i,'found at BUS',dev.bus,' ADR', dev.address)
-        print('usage: sudo usblrb.py -d <deviceno> -s <status>')
+        lines = ['DEVICE %d found at BUS %d  ADR %d' % ((i,) + deviceLocation(d))
+                 for i, d in enumerate(devs)] # the decive list...
+        lines.append(usage)
+        print('\n'.join(lines)) # ...printed at once
         sys.exit()
     else:
         try:
@@ -243,49 +524,60 @@ def main(argv):
         print('Device error!')
         sys.exit()
     ### Hurray! We have a device object now!
-    print('DEVICE',devIndex,'found at BUS',dev.bus,' ADR', dev.address)
-
+    bus, address = deviceLocation(dev)
+    print('DEVICE',devIndex,'found at BUS',bus,' ADR', address)
 
     ### Now get new STATUS from command line...
-    if statusString=='': # no status specified in command line
-        # Test if it is a USB-LRB or not
-        # and read the current status in case...
-        oldStatus = getRelays() # get the relay status
-        testStatus = not oldStatus
-        shiftOutBits(testStatus) # shift out some other status (silent without latch)
-        status = getRelays() # readback new (test status)
-        if status == testStatus: # does it match?
-           print('Status read: ',oldStatus) # print out the status
-           shiftOutBits(oldStatus) # restore status we had before test
-        else:
-           print('Bad device') # this is likely not a USB-LRB
-        sys.exit()
+    ### (checked before the device is opened, bad input needs no USB)
+    newStat = None
+    if statusString!='':
+        try:
+            newStat = int(statusString)
+        except ValueError:
+            print('Invalid status value!')
+            sys.exit()
 
-    try:
-        newStat = int(statusString)
-    except ValueError:
-        print('Invalid status value!')
-        sys.exit()
+        if not 0 <= newStat <= 255:
+            print('Status value out of range (must be 0..255)')
+            sys.exit()
+        ### Hurray! We have a status value!
 
-    if not (newStat in range(0,256)):
-        print('Status value out of range (must be 0..255)')
-        sys.exit()
-    ### Hurray! We have a status value!
-        
+    openDevice()
+    try:
+        if newStat is None: # no status specified in command line
+            # Test if it is a USB-LRB or not
+            # and read the current status in case...
+            oldStatus = getRelays() # get the relay status
+            if oldStatus == -1: # nothing to test or restore then
+                print('Power fail! (check relay board power supply)')
+                sys.exit()
+            testStatus = not oldStatus
+            shiftOutBits(testStatus) # shift out some other status (silent without latch)
+            status = getRelays() # readback new (test status)
+            if status == testStatus: # does it match?
+               print('Status read: ',oldStatus) # print out the status
+               shiftOutBits(oldStatus) # restore status we had before test
+            else:
+               print('Bad device') # this is likely not a USB-LRB
+            sys.exit()
 
-    ### Finally we set the new relay status on (global) device ....
-    setRelays(newStat)
-    print('Status set to', newStat)
+        ### Finally we set the new relay status on (global) device ....
+        setRelays(newStat)
+        print('Status set to', newStat)
 
-    ### if you feel better with that, you can verify... 
-    if getRelays()==newStat:
-        print('Verified successfully.')
-    else:
-        print('Verfication failed!')
+        ### if you feel better with that, you can verify... 
+        if getRelays()==newStat:
+            print('Verified successfully.')
+        else:
+            print('Verfication failed!')
+    finally:
+        closeDevice() # also when sys.exit() was called above
 
-    
 
 ##############################################################
 ### call the main method with arguments from command line ...
 if __name__ == "__main__":
-   main(sys.argv[1:])
+   try:
+      main(sys.argv[1:])
+   finally:
+      closeContext() # devices are closed by main() itself